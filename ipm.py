@@ -25,9 +25,18 @@
 
 
 import argparse
+import concurrent.futures
+import copy
+import fnmatch
+import gzip
+import hashlib
+import io
 import os
+import re
 import sys
 import shutil
+import tarfile
+import tempfile
 from lxml import etree
 
 
@@ -42,6 +51,8 @@ Program capabilities:
   - add folder struct to existing project;
   - clean EWARM workspace folder;
   - rename existing workspace and project;
+  - pack project to archive and unpack it;
+  - compare and merge project files;
 
 usage: ipm <command> <args> [-h | --help]
 
@@ -52,6 +63,10 @@ commands:
     rename_workspace    Rename workspace
     rename_project      Rename project
     rename              Rename both workspace and project
+    pack                Pack project files to archive
+    unpack              Unpack project from archive
+    diff                Compare two project files
+    merge               Three-way merge project files
 
 For details use: ipm <command> -h
 
@@ -89,12 +104,18 @@ extentions devided with "/" char (for example "-i c/h/cpp/icf/").
 CLEAN_HELP_MESSAGE = '''
 Clean workspace folder - delete all files and folders except *.eww and *.ewp.
 
-usage: ipm clean <workspace_path> [-h | --help]
+usage: ipm clean <workspace_path> [archive] [include] [exclude] [-h | --help]
 
 parameters:
   -w, --workspace_path <path>   Workspace path
-
-For usage - just specify workspace path.
+  -a, --archive <path>          Archive deleted files before deleting
+  -i, --include <patterns>      Archive only files matching patterns
+  -e, --exclude <patterns>      Do not archive files matching patterns
+
+For usage - just specify workspace path. To keep build output specify archive
+path with *.tar, *.tar.gz, *.tar.bz2 or *.tar.xz extention and file name
+patterns devided with "/" char (for example -i "*.out/*.hex/*.map").
+Archive must be placed outside workspace folder.
 '''
 
 RENAME_WORKSPACE_HELP_MESSAGE = '''
@@ -106,37 +127,131 @@ parameters:
   -w, --workspace_path <path>   Workspace path
   -n, --name <name>             New workspace name
 
-For usage - just specify workspace path and new workspace name.
+For usage - just specify workspace path and new workspace name. Workspace
+settings files (*.wsdt, *.wspos, *.dni) are renamed too.
 '''
 
 RENAME_PROJECT_HELP_MESSAGE = '''
 Rename project with specified name.
 
-usage: ipm rename_project <project_path> <workspace_path> <name> [-h | --help]
+usage: ipm rename_project <project_path> <workspace_path> <name> [move]
+                          [-h | --help]
 
 parameters:
   -p, --project_path <path>     Project path
   -w, --workspace_path <path>   Workspace path
   -n, --name <name>             New project name
+  -m, --move                    Rename project root folder too
 
 For usage - just specify project path, workspace containing this project path
-and new project name.
+and new project name. All references to old project name in workspace,
+project, dependency and settings files (output *.hex and *.out files names
+for example) are replaced with new project name.
 '''
 
 RENAME_HELP_MESSAGE = '''
 Rename both workspace and project with specified name.
 
-usage: ipm rename <project_path> <workspace_path> <name> [-h | --help]
+usage: ipm rename <project_path> <workspace_path> <name> [move] [-h | --help]
 
 parameters:
   -p, --project_path <path>     Project path
   -w, --workspace_path <path>   Workspace path
   -n, --name <name>             New project name
+  -m, --move                    Rename project root folder too
 
 For usage - just specify project path, workspace containing this project path
-and new project name.
+and new project name. All references to old project name in workspace,
+project, dependency and settings files (output *.hex and *.out files names
+for example) are replaced with new project name.
 '''
 
+PACK_HELP_MESSAGE = '''
+Pack project to archive - only EWARM workspace, project and settings files
+(*.eww, *.ewp, *.ewd, *.ewt) and files and folders referenced in project file.
+
+usage: ipm pack <project_path> <archive> [-h | --help]
+
+parameters:
+  -p, --project_path <path>     Project path
+  -a, --archive <path>          Archive path
+
+For usage - just specify project path and archive path with *.tar, *.tar.gz,
+*.tar.bz2 or *.tar.xz extention. Archive is reproducible - entries are sorted
+and have fixed time and owner, files with same content are stored once.
+'''
+
+UNPACK_HELP_MESSAGE = '''
+Unpack project from archive created with pack command.
+
+usage: ipm unpack <archive> [destination] [-h | --help]
+
+parameters:
+  -a, --archive <path>          Archive path
+  -d, --destination <path>      Destination folder (current folder default)
+
+For usage - just specify archive path and destination folder. Archive must
+have single project root folder not existing in destination folder.
+'''
+
+DIFF_HELP_MESSAGE = '''
+Compare two project files structurally.
+
+usage: ipm diff <project_path> <other_path> [-h | --help]
+
+parameters:
+  -p, --project_path <path>     Project path
+  -o, --other_path <path>       Other project path
+
+For usage - just specify two project paths. Groups, files, configurations,
+settings and options are compared by name, so formatting and order changes
+are ignored. Each difference is printed as "<mark> <tag> <path>" line, where
+mark is "+" for added, "-" for removed and "~" for changed element.
+'''
+
+MERGE_HELP_MESSAGE = '''
+Three-way merge project files structurally.
+
+usage: ipm merge <base_path> <project_path> <other_path> [result_path]
+                 [-h | --help]
+
+parameters:
+  -b, --base_path <path>        Common ancestor project path
+  -p, --project_path <path>     Project path
+  -o, --other_path <path>       Other project path
+  -r, --result_path <path>      Merged project path (project path default)
+
+For usage - just specify common ancestor, project and other project paths.
+Groups, files, configurations, settings and options are merged by name. If
+same element is changed differently in both projects, conflicts are printed
+and result is not written.
+'''
+
+
+# Supported archive extentions and tarfile stream write modes
+ARCHIVE_MODES = [(".tar.gz", "w|gz"), (".tgz", "w|gz"),
+                 (".tar.bz2", "w|bz2"), (".tbz2", "w|bz2"),
+                 (".tar.xz", "w|xz"), (".txz", "w|xz"),
+                 (".tar", "w|")]
+
+# EWARM workspace, project, debugger and tools settings files extentions
+EWARM_EXTENTIONS = [".eww", ".ewp", ".ewd", ".ewt"]
+
+# Maximum number of files read from archive and not written yet while unpack
+UNPACK_PENDING_WRITES = 32
+
+# Project file elements identified by name and elements merged by children
+KEYED_TAGS = ["configuration", "settings", "option", "group", "file"]
+RECURSIVE_TAGS = ["project", "configuration", "settings", "data", "group"]
+
+# Project, output and project settings files extentions, only names with
+# these extentions are project name references replaced while project renaming
+PROJECT_EXTENTIONS = (r"(?:ewp|ewd|ewt|dep|out|hex|map|bin|srec|sim|"
+                      r"dbgdt|crun|\w+\.cspy)\b")
+
+# Workspace settings files extentions, renamed with workspace
+WORKSPACE_EXTENTIONS = r"(?:wsdt|wspos|dni)\b"
+
 
 
 
@@ -170,6 +285,9 @@ def CreateArgParser():
     # Clean command ------------------------------------------------------------
     clean_parser = subparsers.add_parser("clean", add_help = False)
     clean_parser.add_argument("-w", "--workspace_path", help = "Workspace path")
+    clean_parser.add_argument("-a", "--archive", help = "Archive path")
+    clean_parser.add_argument("-i", "--include", help = "Include patterns")
+    clean_parser.add_argument("-e", "--exclude", help = "Exclude patterns")
     clean_parser.add_argument("-h", "--help", help = "Help",
                               action = "store_const", const = True)
 
@@ -192,6 +310,9 @@ def CreateArgParser():
                                        help = "Workspace path")
     rename_project_parser.add_argument("-n", "--name",
                                        help = "New project name")
+    rename_project_parser.add_argument("-m", "--move",
+                                       help = "Rename project root folder",
+                                       action = "store_const", const = True)
     rename_project_parser.add_argument("-h", "--help", help = "Help",
                                        action = "store_const", const = True)
 
@@ -203,9 +324,47 @@ def CreateArgParser():
                                help = "Workspace path")
     rename_parser.add_argument("-n", "--name",
                                help = "New project and workspace name")
+    rename_parser.add_argument("-m", "--move",
+                               help = "Rename project root folder",
+                               action = "store_const", const = True)
     rename_parser.add_argument("-h", "--help", help = "Help",
                                action = "store_const", const = True)
 
+    # Pack command -------------------------------------------------------------
+    pack_parser = subparsers.add_parser("pack", add_help = False)
+    pack_parser.add_argument("-p", "--project_path", help = "Project path")
+    pack_parser.add_argument("-a", "--archive", help = "Archive path")
+    pack_parser.add_argument("-h", "--help", help = "Help",
+                             action = "store_const", const = True)
+
+    # Unpack command -----------------------------------------------------------
+    unpack_parser = subparsers.add_parser("unpack", add_help = False)
+    unpack_parser.add_argument("-a", "--archive", help = "Archive path")
+    unpack_parser.add_argument("-d", "--destination", default = ".",
+                               help = "Destination folder")
+    unpack_parser.add_argument("-h", "--help", help = "Help",
+                               action = "store_const", const = True)
+
+    # Diff command -------------------------------------------------------------
+    diff_parser = subparsers.add_parser("diff", add_help = False)
+    diff_parser.add_argument("-p", "--project_path", help = "Project path")
+    diff_parser.add_argument("-o", "--other_path",
+                             help = "Other project path")
+    diff_parser.add_argument("-h", "--help", help = "Help",
+                             action = "store_const", const = True)
+
+    # Merge command ------------------------------------------------------------
+    merge_parser = subparsers.add_parser("merge", add_help = False)
+    merge_parser.add_argument("-b", "--base_path",
+                              help = "Common ancestor project path")
+    merge_parser.add_argument("-p", "--project_path", help = "Project path")
+    merge_parser.add_argument("-o", "--other_path",
+                              help = "Other project path")
+    merge_parser.add_argument("-r", "--result_path",
+                              help = "Merged project path")
+    merge_parser.add_argument("-h", "--help", help = "Help",
+                              action = "store_const", const = True)
+
     return parser
 
 
@@ -413,10 +572,6 @@ def ChangeProjectFile(project_name, device):
     replace_text = "$PROJ_DIR$\..\source\CMSIS\Include\\" + device_core
     ReplaceTextInFile(project_file, text_to_replace, replace_text)
 
-    # Replace output .hex and .out files name
-    ReplaceTextInFile(project_file, "template.hex", project_name + ".hex")
-    ReplaceTextInFile(project_file, "tempalte.out", project_name + ".out")
-
 
 # ------------------------------------------------------------------------------
 # Copy folder to project source directory. Add folder in project file
@@ -501,12 +656,18 @@ def AppendNode(node_tag, parent_node, node_name):
 # ------------------------------------------------------------------------------
 # Clean workspace folder - delete all files and folders except *.eww and *.ewp
 # ------------------------------------------------------------------------------
-def Clean(workspace_path):
+def Clean(workspace_path, archive_path = None, include = None,
+          exclude = None):
     if os.path.isfile(workspace_path):
         if workspace_path.endswith(".eww"):
             workspace_folder = workspace_path.split("/")[0:-1]
             workspace_folder = "/".join(workspace_folder)
 
+            # Archive files to be deleted
+            if archive_path != None:
+                ArchiveWorkspace(workspace_folder, archive_path,
+                                 include, exclude)
+
             for item in os.listdir(workspace_folder):
                 item_path = workspace_folder + "/" + item
                 if os.path.isfile(item_path):
@@ -527,6 +688,94 @@ def Clean(workspace_path):
         Exit("Can not find: \"" + workspace_path + "\" file")
 
 
+# Stream all files to be deleted into compressed archive. Files are compressed
+# while workspace folder is walked, each file is read only once
+def ArchiveWorkspace(workspace_folder, archive_path, include, exclude):
+    mode = ArchiveMode(archive_path)
+
+    workspace_abspath = os.path.abspath(workspace_folder)
+    if os.path.abspath(archive_path).startswith(workspace_abspath + os.sep):
+        Exit("Archive \"" + archive_path + "\" is inside workspace folder")
+
+    # Archive is written to temporary file and replaces target only when
+    # complete, so failed archiving never leaves truncated archive
+    try:
+        temp_path = ArchiveTempPath(archive_path)
+        archive = tarfile.open(temp_path, mode)
+    except (IOError, OSError, tarfile.TarError):
+        Exit("Can not create \"" + archive_path + "\" archive")
+
+    error_message = "Can not write \"" + archive_path + "\" archive"
+    try:
+        for path, folders, files in os.walk(workspace_abspath):
+            folders.sort()
+            for item in sorted(files):
+                if path == workspace_abspath:
+                    if item.endswith(".eww") or item.endswith(".ewp"):
+                        continue
+                if not MatchPatterns(item, include, exclude):
+                    continue
+
+                item_path = os.path.join(path, item)
+                arcname = os.path.relpath(item_path, workspace_abspath)
+                error_message = "Can not archive \"" + item_path + "\" file"
+                archive.add(item_path, arcname, recursive = False)
+
+        error_message = "Can not write \"" + archive_path + "\" archive"
+        archive.close()
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, archive_path)
+    except (IOError, OSError, tarfile.TarError):
+        AbortArchive([archive], temp_path, error_message)
+
+
+# Get tarfile stream write mode by archive extention
+def ArchiveMode(archive_path):
+    for extention, archive_mode in ARCHIVE_MODES:
+        if archive_path.endswith(extention):
+            return archive_mode
+
+    Exit("Unsupported archive format \"" + archive_path + "\"")
+
+
+# Create temporary file next to archive. Archive is written to temporary file
+# and replaces target only when complete
+def ArchiveTempPath(archive_path):
+    handle, temp_path = tempfile.mkstemp(
+        dir = os.path.dirname(archive_path) or ".")
+    os.close(handle)
+
+    return temp_path
+
+
+# Close archive files, remove temporary archive and exit
+def AbortArchive(archive_files, temp_path, exit_message):
+    for archive_file in archive_files:
+        try:
+            archive_file.close()
+        except (IOError, OSError, tarfile.TarError):
+            pass
+    try:
+        os.remove(temp_path)
+    except OSError:
+        pass
+    Exit(exit_message)
+
+
+# Check file name with "/" devided include and exclude patterns
+def MatchPatterns(file_name, include, exclude):
+    if include != None:
+        if not any(fnmatch.fnmatch(file_name, x)
+                   for x in include.split("/") if x != ""):
+            return False
+    if exclude != None:
+        if any(fnmatch.fnmatch(file_name, x)
+               for x in exclude.split("/") if x != ""):
+            return False
+
+    return True
+
+
 # ------------------------------------------------------------------------------
 # Rename workspace with specified name
 # ------------------------------------------------------------------------------
@@ -534,12 +783,23 @@ def RenameWorkspace(workspace_path, new_workspace_name):
     if os.path.isfile(workspace_path):
         if workspace_path.endswith(".eww"):
             rename_path = workspace_path.split("/")
+            old_workspace_name = rename_path[-1][0:-4]
             rename_path[-1] = new_workspace_name + ".eww"
             rename_path = "/".join(rename_path)
             try:
                 os.rename(workspace_path, rename_path)
             except OSError:
                 Exit("Can not rename \"" + workspace_path + "\" file")
+
+            # Rename workspace settings files and references to them
+            settings_folder = os.path.join(os.path.dirname(workspace_path),
+                                           "settings")
+            if os.path.isdir(settings_folder):
+                pattern = re.compile(r"(?<![\w.-])" +
+                                     re.escape(old_workspace_name) +
+                                     r"(?=\." + WORKSPACE_EXTENTIONS + r")")
+                RenameNamedFiles([settings_folder], pattern,
+                                 old_workspace_name, new_workspace_name)
         else:
             Exit("\"" + workspace_path + "\" is not *.eww file")
     else:
@@ -555,19 +815,24 @@ def RenameProject(project_path, workspace_path, new_project_name):
             if project_path.endswith(".ewp"):
                 if workspace_path.endswith(".eww"):
 
-                    rename_path = project_path.split("/")
-                    old_project_name = rename_path[-1]
-                    rename_path[-1] = new_project_name + ".ewp"
-                    rename_path = "/".join(rename_path)
-                    try:
-                        os.rename(project_path, rename_path)
-                    except OSError:
-                        Exit("Can non rename \"" + project_path + "\" file")
-
-                    text_to_replace = "$WS_DIR$\\" + old_project_name
-                    replace_text = "$WS_DIR$\\" + new_project_name + ".ewp"
-                    ReplaceTextInFile(workspace_path, text_to_replace,
-                                      replace_text)
+                    project_folder = os.path.dirname(project_path) or "."
+                    old_project_name = os.path.basename(project_path)[0:-4]
+                    pattern = re.compile(r"(?<![\w.-])" +
+                                         re.escape(old_project_name) +
+                                         r"(?=\." + PROJECT_EXTENTIONS + r")")
+
+                    # Replace old project name in workspace file, rename
+                    # project, dependency and settings files and replace
+                    # old project name in them
+                    ReplacePatternInFile(workspace_path,
+                                         [(pattern, lambda match:
+                                           new_project_name)])
+                    folders = [project_folder]
+                    if os.path.isdir(os.path.join(project_folder, "settings")):
+                        folders.append(os.path.join(project_folder,
+                                                    "settings"))
+                    RenameNamedFiles(folders, pattern, old_project_name,
+                                     new_project_name)
 
                 else:
                     Exit("\"" + workspace_path + "\" is not *.eww file")
@@ -581,6 +846,472 @@ def RenameProject(project_path, workspace_path, new_project_name):
 
 
 
+# Index files in folders and replace name references in them in one pass per
+# file. First folder files are rewritten only if renamed, settings folder files
+# are always rewritten. Files with name matched by pattern are renamed
+def RenameNamedFiles(folders, pattern, old_name, new_name):
+    rewrite_list = []
+    rename_list = []
+    for folder in folders:
+        for item in sorted(os.listdir(folder)):
+            item_path = os.path.join(folder, item)
+            if not os.path.isfile(item_path) or item.endswith(".eww"):
+                continue
+
+            named_file = pattern.match(item) != None
+            if named_file:
+                rename_list.append(item_path)
+            if named_file or folder != folders[0]:
+                rewrite_list.append(item_path)
+
+    for file_name in rewrite_list:
+        ReplacePatternInFile(file_name, [(pattern, lambda match: new_name)])
+
+    for file_name in rename_list:
+        rename_path = os.path.join(os.path.dirname(file_name), new_name +
+                                   os.path.basename(file_name)[len(old_name):])
+        try:
+            os.rename(file_name, rename_path)
+        except OSError:
+            Exit("Can not rename \"" + file_name + "\" file")
+
+
+# ------------------------------------------------------------------------------
+# Rename project root folder - folder containing EWARM and source folders
+# ------------------------------------------------------------------------------
+def MoveProjectFolder(project_folder, new_folder_name):
+    root_folder = os.path.dirname(os.path.abspath(project_folder))
+    old_folder_name = os.path.basename(root_folder)
+    rename_path = ProjectFolderRenamePath(project_folder, new_folder_name)
+
+    # Replace $PROJ_DIR$ relative paths passing through project root folder
+    pattern = re.compile(r"(?<=\$PROJ_DIR\$[\\/]\.\.[\\/]\.\.[\\/])" +
+                         re.escape(old_folder_name) + r"(?=[\\/])")
+    for item in sorted(os.listdir(project_folder)):
+        if item.endswith(".ewp") or item.endswith(".dep"):
+            ReplacePatternInFile(os.path.join(project_folder, item),
+                                 [(pattern, lambda match: new_folder_name)])
+
+    try:
+        os.rename(root_folder, rename_path)
+    except OSError:
+        Exit("Can not rename \"" + root_folder + "\" folder")
+
+
+# Get renamed project root folder path. Exit if folder already exists
+def ProjectFolderRenamePath(project_folder, new_folder_name):
+    root_folder = os.path.dirname(os.path.abspath(project_folder))
+    rename_path = os.path.join(os.path.dirname(root_folder), new_folder_name)
+    if os.path.exists(rename_path):
+        Exit("\"" + rename_path + "\" folder already exists")
+
+    return rename_path
+
+
+
+
+# ------------------------------------------------------------------------------
+# Pack project to reproducible archive
+# ------------------------------------------------------------------------------
+def Pack(project_path, archive_path):
+    if os.path.isfile(project_path):
+        if project_path.endswith(".ewp"):
+            project_folder = os.path.dirname(os.path.abspath(project_path))
+            root_folder = os.path.dirname(project_folder)
+            root_name = os.path.basename(root_folder)
+
+            # Collect EWARM files, files and folders referenced in project
+            pack_files, pack_folders = ProjectReferences(project_path,
+                                                         project_folder)
+            for item in os.listdir(project_folder):
+                if any(item.endswith(x) for x in EWARM_EXTENTIONS):
+                    pack_files.add(os.path.join(project_folder, item))
+
+            arcnames = {}
+            for file_name in pack_files | pack_folders:
+                arcname = os.path.relpath(file_name, root_folder)
+                if arcname.startswith(".."):
+                    Exit("\"" + file_name + "\" is outside project folder")
+                arcname = root_name + "/" + arcname.replace(os.sep, "/")
+                arcnames[arcname] = file_name
+
+            archive, archive_files, temp_path = OpenPackArchive(archive_path)
+
+            # Add entries in sorted order, store same content files as links
+            stored_files = {}
+            error_message = "Can not write \"" + archive_path + "\" archive"
+            try:
+                for arcname in sorted(arcnames):
+                    file_name = arcnames[arcname]
+                    info = tarfile.TarInfo(arcname)
+                    info.mtime = 0
+                    if file_name in pack_folders:
+                        info.type = tarfile.DIRTYPE
+                        info.mode = 0o755
+                        archive.addfile(info)
+                        continue
+
+                    error_message = "Can not read \"" + file_name + "\" file"
+                    file = open(file_name, "rb")
+                    data = file.read()
+                    file.close()
+
+                    error_message = ("Can not write \"" + archive_path +
+                                     "\" archive")
+                    info.mode = 0o644
+                    digest = hashlib.sha256(data).digest()
+                    if digest in stored_files:
+                        info.type = tarfile.LNKTYPE
+                        info.linkname = stored_files[digest]
+                        archive.addfile(info)
+                    else:
+                        stored_files[digest] = arcname
+                        info.size = len(data)
+                        archive.addfile(info, io.BytesIO(data))
+
+                archive.close()
+                for archive_file in archive_files:
+                    archive_file.close()
+                os.chmod(temp_path, 0o644)
+                os.replace(temp_path, archive_path)
+            except (IOError, OSError, tarfile.TarError):
+                AbortArchive([archive] + archive_files, temp_path,
+                             error_message)
+
+        else:
+            Exit("\"" + project_path + "\" is not *.ewp file")
+    else:
+        Exit("Can not find: \"" + project_path + "\" file")
+
+
+# Get existing files and folders referenced in project file with $PROJ_DIR$
+# path. Files of referenced folders (include paths for example) are referenced
+# too
+def ProjectReferences(project_path, project_folder):
+    references = set()
+    folders = set()
+    try:
+        root = etree.parse(project_path).getroot()
+    except (IOError, etree.XMLSyntaxError):
+        Exit("Can not parse \"" + project_path + "\" file")
+
+    for node in root.iter("name", "state"):
+        if node.text == None or not node.text.startswith("$PROJ_DIR$"):
+            continue
+
+        path = node.text.replace("$PROJ_DIR$", project_folder)
+        path = os.path.normpath(path.replace("\\", "/"))
+        if os.path.isfile(path):
+            references.add(path)
+        elif os.path.isdir(path):
+            folders.add(path)
+            for item in os.listdir(path):
+                if os.path.isfile(os.path.join(path, item)):
+                    references.add(os.path.join(path, item))
+        elif node.tag == "name":
+            print("Can not find \"" + path + "\" file, file is not packed")
+
+    return references, folders
+
+
+# Open temporary archive for deterministic write. Gzip header time is fixed
+# too. Returns archive, list of underlying files to close after archive and
+# temporary archive path
+def OpenPackArchive(archive_path):
+    mode = ArchiveMode(archive_path)
+    try:
+        temp_path = ArchiveTempPath(archive_path)
+        archive_files = [open(temp_path, "wb")]
+        if mode == "w|gz":
+            archive_files.insert(0, gzip.GzipFile("", "wb", mtime = 0,
+                                                  fileobj = archive_files[0]))
+            mode = "w|"
+        archive = tarfile.open(fileobj = archive_files[0], mode = mode,
+                               format = tarfile.PAX_FORMAT)
+    except (IOError, OSError, tarfile.TarError):
+        Exit("Can not create \"" + archive_path + "\" archive")
+
+    return archive, archive_files, temp_path
+
+
+# ------------------------------------------------------------------------------
+# Unpack project from archive
+# ------------------------------------------------------------------------------
+def Unpack(archive_path, destination_folder):
+    if os.path.isfile(archive_path):
+        try:
+            archive = tarfile.open(archive_path, "r|*")
+        except (IOError, OSError, tarfile.TarError):
+            Exit("Can not open \"" + archive_path + "\" archive")
+
+        # Archive is read sequentially, files are written in parallel. Number
+        # of files read and not written yet is limited to keep memory low
+        executor = concurrent.futures.ThreadPoolExecutor()
+        futures = set()
+        links = []
+        extracted = set()
+        root_name = None
+        try:
+            for member in archive:
+                name = os.path.normpath(member.name)
+                if (os.path.isabs(name) or name.startswith("..") or
+                    not (member.isfile() or member.islnk() or
+                         member.isdir())):
+                    Exit("Unsafe \"" + member.name + "\" archive entry")
+
+                # Packed project has single root folder, it must not exist
+                if root_name == None:
+                    root_name = name.split(os.sep)[0]
+                    root_path = os.path.join(destination_folder, root_name)
+                    if os.path.exists(root_path):
+                        Exit("\"" + root_path + "\" folder already exists")
+                elif name.split(os.sep)[0] != root_name:
+                    Exit("\"" + archive_path + "\" has more than one root " +
+                         "folder")
+
+                path = os.path.join(destination_folder, name)
+                if member.isdir():
+                    os.makedirs(path, exist_ok = True)
+                elif member.islnk():
+                    link = os.path.normpath(member.linkname)
+                    if link not in extracted:
+                        Exit("Unsafe \"" + member.name + "\" archive entry")
+                    links.append((os.path.join(destination_folder, link),
+                                  path))
+                else:
+                    if len(futures) >= UNPACK_PENDING_WRITES:
+                        done, futures = concurrent.futures.wait(
+                            futures,
+                            return_when = concurrent.futures.FIRST_COMPLETED)
+                        WaitFutures(done)
+                    data = archive.extractfile(member).read()
+                    futures.add(executor.submit(WriteFile, path, data))
+                    extracted.add(name)
+        except (IOError, OSError, tarfile.TarError):
+            Exit("Can not read \"" + archive_path + "\" archive")
+
+        # Same content files are restored as copies after their sources
+        WaitFutures(futures)
+        futures = [executor.submit(CopyLinkedFile, src, dst)
+                   for src, dst in links]
+        WaitFutures(futures)
+        executor.shutdown()
+        archive.close()
+    else:
+        Exit("Can not find: \"" + archive_path + "\" file")
+
+
+# Write data to file creating parent folders
+def WriteFile(file_name, data):
+    os.makedirs(os.path.dirname(file_name) or ".", exist_ok = True)
+    with open(file_name, "wb") as file:
+        file.write(data)
+
+    return file_name
+
+
+# Copy file creating parent folders
+def CopyLinkedFile(src, dst):
+    os.makedirs(os.path.dirname(dst) or ".", exist_ok = True)
+    shutil.copyfile(src, dst)
+
+    return dst
+
+
+# Wait for file writing futures and exit on first failed
+def WaitFutures(futures):
+    for future in futures:
+        try:
+            future.result()
+        except (IOError, OSError):
+            Exit("Can not write \"" + str(future.exception().filename) +
+                 "\" file")
+
+
+# ------------------------------------------------------------------------------
+# Compare two project files structurally
+# ------------------------------------------------------------------------------
+def Diff(project_path, other_path):
+    project_node = ParseProjectFile(project_path)
+    other_node = ParseProjectFile(other_path)
+
+    differences = []
+    DiffNodes(project_node, other_node, "", differences)
+    for difference in differences:
+        print(difference)
+
+
+# Compare nodes and append differences. Subtrees with same signature are skipped
+def DiffNodes(node, other_node, path, differences):
+    if node["signature"] == other_node["signature"]:
+        return
+
+    children = NodeChildren(node)
+    other_children = NodeChildren(other_node)
+    if children == None or other_children == None:
+        differences.append("~ " + node["element"].tag + " " + path)
+        return
+
+    for key, child in children.items():
+        child_path = path + "/" + child["label"] if path else child["label"]
+        if key in other_children:
+            DiffNodes(child, other_children[key], child_path, differences)
+        else:
+            differences.append("- " + child["element"].tag + " " + child_path)
+
+    for key, child in other_children.items():
+        if key not in children:
+            child_path = path + "/" + child["label"] if path else child["label"]
+            differences.append("+ " + child["element"].tag + " " + child_path)
+
+
+# ------------------------------------------------------------------------------
+# Three-way merge project files structurally
+# ------------------------------------------------------------------------------
+def Merge(base_path, project_path, other_path, result_path):
+    base_node = ParseProjectFile(base_path)
+    project_node = ParseProjectFile(project_path)
+    other_node = ParseProjectFile(other_path)
+
+    conflicts = []
+    root = MergeNodes(base_node, project_node, other_node, "", conflicts)
+    if conflicts:
+        for conflict in conflicts:
+            print("conflict: " + conflict)
+        Exit("Can not merge projects, \"" + result_path + "\" is not written")
+
+    try:
+        xml_file = open(result_path, "wb")
+        xml_file.write(etree.tostring(root, pretty_print = True,
+                       encoding = "iso-8859-1", xml_declaration = True))
+        xml_file.close()
+    except IOError:
+        Exit("Can not write \"" + result_path + "\" file")
+
+
+# Merge nodes and return merged element or None if element is deleted
+def MergeNodes(base_node, node, other_node, path, conflicts):
+    base_signature = base_node["signature"] if base_node else None
+    signature = node["signature"] if node else None
+    other_signature = other_node["signature"] if other_node else None
+
+    # Not changed in one of projects or changed the same way
+    if signature == other_signature or base_signature == other_signature:
+        return node["element"] if node else None
+    if base_signature == signature:
+        return other_node["element"] if other_node else None
+
+    # Changed in both projects, merge children if possible
+    children = NodeChildren(node) if node else None
+    other_children = NodeChildren(other_node) if other_node else None
+    if children == None or other_children == None:
+        tag = node["element"].tag if node else other_node["element"].tag
+        conflicts.append(tag + " " + path)
+        return node["element"] if node else None
+
+    base_children = NodeChildren(base_node) if base_node else None
+    if base_children == None:
+        base_children = {}
+
+    merged = etree.Element(node["element"].tag, node["element"].attrib)
+    merged.text = node["element"].text
+    for key in MergeKeys(children, other_children):
+        child = children.get(key)
+        other_child = other_children.get(key)
+        label = child["label"] if child else other_child["label"]
+        child_path = path + "/" + label if path else label
+        element = MergeNodes(base_children.get(key), child, other_child,
+                             child_path, conflicts)
+        if element is not None:
+            # Source trees are not changed, elements are copied to result
+            merged.append(copy.deepcopy(element))
+
+    return merged
+
+
+# Merge children keys order. Keys only in other children are placed after
+# the same preceding common key as in other children order, but after keys
+# only in children following this common key
+def MergeKeys(children, other_children):
+    following = {}
+    previous_key = None
+    for key in other_children:
+        if key in children:
+            previous_key = key
+        else:
+            following.setdefault(previous_key, []).append(key)
+
+    keys = []
+    previous_key = None
+    for key in children:
+        if key in other_children:
+            keys += following.pop(previous_key, [])
+            previous_key = key
+        keys.append(key)
+    keys += following.pop(previous_key, [])
+
+    return keys
+
+
+# Parse project file to tree of nodes with hashed signatures
+# Extention is not checked, git merge driver passes temporary files
+def ParseProjectFile(project_path):
+    if os.path.isfile(project_path):
+        parser = etree.XMLParser(remove_blank_text = True,
+                                 remove_comments = True)
+        try:
+            root = etree.parse(project_path, parser).getroot()
+        except (IOError, etree.XMLSyntaxError):
+            Exit("Can not parse \"" + project_path + "\" file")
+        if root.tag != "project":
+            Exit("\"" + project_path + "\" is not project file")
+
+        return ParseNode(root, root.tag)
+
+    else:
+        Exit("Can not find: \"" + project_path + "\" file")
+
+
+# Make node with signature of element. Signature is hash of serialized element,
+# so equal subtrees are compared in O(1) and never walked
+def ParseNode(element, label):
+    signature = hashlib.sha1(etree.tostring(element, with_tail = False))
+    return {"element": element, "label": label,
+            "signature": signature.digest(), "children": None}
+
+
+# Get node children on first use. Children of recursive elements are keyed with
+# tag and name (or tag only), duplicated keys are numbered. None for leaf nodes
+def NodeChildren(node):
+    element = node["element"]
+    if element.tag not in RECURSIVE_TAGS:
+        return None
+    if node["children"] != None:
+        return node["children"]
+
+    children = {}
+    for child in element:
+        if child.tag in KEYED_TAGS:
+            # Name is first child in IAR files, findtext is much slower
+            if len(child) and child[0].tag == "name":
+                name = child[0].text
+            else:
+                name = child.findtext("name")
+        else:
+            name = None
+        key = (child.tag, name, 0)
+        while key in children:
+            key = (child.tag, name, key[2] + 1)
+
+        child_label = name if name != None else child.tag
+        if key[2] != 0:
+            child_label += "[" + str(key[2]) + "]"
+        children[key] = ParseNode(child, child_label)
+
+    node["children"] = children
+    return children
+
+
 # ------------------------------------------------------------------------------
 # Common functions
 # ------------------------------------------------------------------------------
@@ -600,6 +1331,37 @@ def ReplaceTextInFile(file_name, text_to_replace, replace_text):
         Exit("Can not find \"" + file_name + "\" file")
 
 
+# Replace all patterns matches in file. File is read once and replaced
+# atomically, so interrupted rename never leaves half written file
+def ReplacePatternInFile(file_name, replacements):
+    try:
+        file = open(file_name, "r", encoding = "iso-8859-1", newline = "")
+        text = file.read()
+        file.close()
+    except IOError:
+        Exit("Can not handle \"" + file_name + "\" file")
+
+    new_text = text
+    for pattern, replace_text in replacements:
+        new_text = pattern.sub(replace_text, new_text)
+    if new_text != text:
+        WriteFileAtomic(file_name, new_text)
+
+
+# Write text to temporary file and replace original file with it
+def WriteFileAtomic(file_name, text):
+    folder = os.path.dirname(file_name) or "."
+    try:
+        handle, temp_path = tempfile.mkstemp(dir = folder)
+        with os.fdopen(handle, "w", encoding = "iso-8859-1",
+                       newline = "") as file:
+            file.write(text)
+        shutil.copymode(file_name, temp_path)
+        os.replace(temp_path, file_name)
+    except (IOError, OSError):
+        Exit("Can not write \"" + file_name + "\" file")
+
+
 # Copy folder tree
 def CopyTree(src, dst, symlinks = False, ignore = None):
     if not os.path.exists(dst):
@@ -683,7 +1445,10 @@ if __name__ == "__main__":
             arg_parser_namespace.workspace_path == None):
             Exit(CLEAN_HELP_MESSAGE)
         else:
-            Clean(arg_parser_namespace.workspace_path)
+            Clean(arg_parser_namespace.workspace_path,
+                  arg_parser_namespace.archive,
+                  arg_parser_namespace.include,
+                  arg_parser_namespace.exclude)
 
     # Rename workspace command
     elif arg_parser_namespace.command == "rename_workspace":
@@ -703,9 +1468,17 @@ if __name__ == "__main__":
             arg_parser_namespace.name == None):
             Exit(RENAME_PROJECT_HELP_MESSAGE)
         else:
+            if arg_parser_namespace.move == True:
+                ProjectFolderRenamePath(os.path.dirname(
+                    arg_parser_namespace.project_path) or ".",
+                    arg_parser_namespace.name)
             RenameProject(arg_parser_namespace.project_path,
                           arg_parser_namespace.workspace_path,
                           arg_parser_namespace.name)
+            if arg_parser_namespace.move == True:
+                MoveProjectFolder(os.path.dirname(
+                    arg_parser_namespace.project_path) or ".",
+                    arg_parser_namespace.name)
 
     # Rename command
     elif arg_parser_namespace.command == "rename":
@@ -715,11 +1488,63 @@ if __name__ == "__main__":
             arg_parser_namespace.name == None):
             Exit(RENAME_HELP_MESSAGE)
         else:
+            if arg_parser_namespace.move == True:
+                ProjectFolderRenamePath(os.path.dirname(
+                    arg_parser_namespace.project_path) or ".",
+                    arg_parser_namespace.name)
             RenameProject(arg_parser_namespace.project_path,
                           arg_parser_namespace.workspace_path,
                           arg_parser_namespace.name)
             RenameWorkspace(arg_parser_namespace.workspace_path,
                             arg_parser_namespace.name)
+            if arg_parser_namespace.move == True:
+                MoveProjectFolder(os.path.dirname(
+                    arg_parser_namespace.project_path) or ".",
+                    arg_parser_namespace.name)
+
+    # Pack command
+    elif arg_parser_namespace.command == "pack":
+        if (arg_parser_namespace.help == True or
+            arg_parser_namespace.project_path == None or
+            arg_parser_namespace.archive == None):
+            Exit(PACK_HELP_MESSAGE)
+        else:
+            Pack(arg_parser_namespace.project_path,
+                 arg_parser_namespace.archive)
+
+    # Unpack command
+    elif arg_parser_namespace.command == "unpack":
+        if (arg_parser_namespace.help == True or
+            arg_parser_namespace.archive == None):
+            Exit(UNPACK_HELP_MESSAGE)
+        else:
+            Unpack(arg_parser_namespace.archive,
+                   arg_parser_namespace.destination)
+
+    # Diff command
+    elif arg_parser_namespace.command == "diff":
+        if (arg_parser_namespace.help == True or
+            arg_parser_namespace.project_path == None or
+            arg_parser_namespace.other_path == None):
+            Exit(DIFF_HELP_MESSAGE)
+        else:
+            Diff(arg_parser_namespace.project_path,
+                 arg_parser_namespace.other_path)
+
+    # Merge command
+    elif arg_parser_namespace.command == "merge":
+        if (arg_parser_namespace.help == True or
+            arg_parser_namespace.base_path == None or
+            arg_parser_namespace.project_path == None or
+            arg_parser_namespace.other_path == None):
+            Exit(MERGE_HELP_MESSAGE)
+        else:
+            result_path = arg_parser_namespace.result_path
+            if result_path == None:
+                result_path = arg_parser_namespace.project_path
+            Merge(arg_parser_namespace.base_path,
+                  arg_parser_namespace.project_path,
+                  arg_parser_namespace.other_path, result_path)
 
     # Undefined command
     else: